@@ -0,0 +1,72 @@
+// Conversion of lcd glyph bitmaps to display column order
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stdint.h> // uint8_t
+#include "compiler.h" // __visible
+
+#if defined(__SSE2__)
+#include <emmintrin.h> // _mm_movemask_epi8
+#endif
+
+#define SPREAD_MUL  0x8040201008040201ULL
+#define SPREAD_MASK 0x8080808080808080ULL
+
+// Convert an 8x8 block of pixels using a 64-bit multiply per row
+static void
+swizzle_block(uint8_t *out, const uint8_t *in)
+{
+    uint64_t cols = 0;
+    int row, col;
+    for (row = 0; row < 8; row++)
+        cols |= ((in[row] * SPREAD_MUL) & SPREAD_MASK) >> (7 - row);
+    for (col = 0; col < 8; col++)
+        out[col] = cols >> (col * 8);
+}
+
+#if defined(__SSE2__)
+// Convert two 8x8 blocks of pixels at once - movemask gathers the msb of
+// all 16 row bytes (one column of both blocks) and the row bytes are then
+// shifted left one bit to move the next column into the msb
+static void
+swizzle_block_pair(uint8_t *out, const uint8_t *in)
+{
+    __m128i rows = _mm_loadu_si128((const __m128i *)in);
+    int col;
+    for (col = 0; col < 8; col++) {
+        int bits = _mm_movemask_epi8(rows);
+        out[col] = bits;
+        out[col + 8] = bits >> 8;
+        rows = _mm_add_epi8(rows, rows);
+    }
+}
+#else
+// Convert two 8x8 blocks of pixels in one pass over the rows - the two
+// blocks are independent so their multiplies can execute in parallel
+static void
+swizzle_block_pair(uint8_t *out, const uint8_t *in)
+{
+    uint64_t cols1 = 0, cols2 = 0;
+    int row, col;
+    for (row = 0; row < 8; row++) {
+        cols1 |= ((in[row] * SPREAD_MUL) & SPREAD_MASK) >> (7 - row);
+        cols2 |= ((in[row + 8] * SPREAD_MUL) & SPREAD_MASK) >> (7 - row);
+    }
+    for (col = 0; col < 8; col++) {
+        out[col] = cols1 >> (col * 8);
+        out[col + 8] = cols2 >> (col * 8);
+    }
+}
+#endif
+
+// Convert 'count' 8x8 blocks of pixels from "rows of pixels" format (a
+// byte per row, msb on the left) to "columns of pixels" format (a byte
+// per column, lsb on top)
+void __visible
+swizzle_blocks(uint8_t *out, const uint8_t *in, int count)
+{
+    for (; count >= 2; count -= 2, in += 16, out += 16)
+        swizzle_block_pair(out, in);
+    for (; count > 0; count--, in += 8, out += 8)
+        swizzle_block(out, in);
+}
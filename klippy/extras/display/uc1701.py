@@ -4,113 +4,184 @@
 # Copyright (C) 2018  Eric Callahan  <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
+import logging, importlib, operator, re, struct
+import chelper
 from .. import bus
 from . import font8x14
 
 BACKGROUND_PRIORITY_CLOCK = 0x7fffffff00000000
 
-TextGlyphs = { 'right_arrow': b'\x1a', 'degrees': b'\xf8' }
+TextGlyphs = { 'right_arrow': 0x1a, 'degrees': 0xf8 }
+
+# Locate runs of changed bytes in an xor of the old and new framebuffer
+# contents - changes separated by four or fewer unchanged bytes are batched
+DIFF_RUN_RE = re.compile(b'[^\x00](?:\x00{0,4}[^\x00])*')
+# Maximum number of bytes sent to the chip in a single data transfer
+MAX_RUN = 32
+
+# Find runs of changed bytes (the non-zero bytes of the xor of the new and
+# old framebuffer), batching together changes that are close to each
+# other.  Generates (pos, count) tuples.
+def find_diff_runs(xor_data):
+    for m in DIFF_RUN_RE.finditer(xor_data):
+        pos, end = m.span()
+        while end - pos > MAX_RUN:
+            yield (pos, MAX_RUN)
+            pos += MAX_RUN
+        yield (pos, end - pos)
+
+# Xor an 8 byte block of pixel columns into a framebuffer
+def xor_block(buf, pos, data):
+    val = struct.unpack_from('<Q', buf, pos)[0] ^ struct.unpack('<Q', data)[0]
+    struct.pack_into('<Q', buf, pos, val)
 
 class DisplayBase:
     def __init__(self, io, columns=128, x_offset=0):
         self.send = io.send
-        # framebuffers
+        self.send_combined = io.send_combined
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
         self.columns = columns
         self.x_offset = x_offset
-        self.vram = [bytearray(self.columns) for i in range(8)]
-        self.all_framebuffers = [(self.vram[i], bytearray(b'~'*self.columns), i)
-                                 for i in range(8)]
+        # framebuffers (all 8 pages stored contiguously, page by page)
+        self.vram = bytearray(8 * self.columns)
+        self.shadow = bytearray(b'~' * len(self.vram))
+        self.zero_page = bytearray(self.columns)
+        # Bitmask of pages that may have changed since the last flush
+        self.dirty_pages = 0xff
+        # Cache the commands that set the chip's page and column position
+        self.position_cmds = [[bytes(bytearray([0xb0 | page,
+                                                0x10 | ((col >> 4) & 0x0f),
+                                                col & 0x0f]))
+                               for col in range(self.columns)]
+                              for page in range(8)]
+        self.column_cmds = [cmds[1:] for cmds in self.position_cmds[0]]
         # Cache fonts and icons in display byte order
-        self.font = [self._swizzle_bits(bytearray(c))
-                     for c in font8x14.VGA_FONT]
+        font = self._swizzle_blocks(b''.join(font8x14.VGA_FONT))
+        self.font_top = [font[i:i+8] for i in range(0, len(font), 16)]
+        self.font_bot = [font[i+8:i+16] for i in range(0, len(font), 16)]
         self.icons = {}
     def flush(self):
-        # Find all differences in the framebuffers and send them to the chip
-        for new_data, old_data, page in self.all_framebuffers:
+        # Find all differences in the framebuffers
+        dirty_pages = self.dirty_pages
+        if not dirty_pages:
+            return
+        self.dirty_pages = 0
+        if self.vram == self.shadow:
+            return
+        columns = self.columns
+        runs = []
+        for page in range(8):
+            if not dirty_pages & (1 << page):
+                continue
+            start = page * columns
+            new_data = self.vram[start:start+columns]
+            old_data = self.shadow[start:start+columns]
             if new_data == old_data:
                 continue
-            # Find the position of all changed bytes in this framebuffer
-            diffs = [[i, 1] for i, (n, o) in enumerate(zip(new_data, old_data))
-                     if n != o]
-            # Batch together changes that are close to each other
-            for i in range(len(diffs)-2, -1, -1):
-                pos, count = diffs[i]
-                nextpos, nextcount = diffs[i+1]
-                if pos + 5 >= nextpos and nextcount < 16:
-                    diffs[i][1] = nextcount + (nextpos - pos)
-                    del diffs[i+1]
-            # Transmit changes
-            for col_pos, count in diffs:
-                # Set Position registers
-                ra = 0xb0 | (page & 0x0F)
-                ca_msb = 0x10 | ((col_pos >> 4) & 0x0F)
-                ca_lsb = col_pos & 0x0F
-                self.send([ra, ca_msb, ca_lsb])
-                # Send Data
-                self.send(new_data[col_pos:col_pos+count], is_data=True)
-            old_data[:] = new_data
+            if new_data == self.zero_page:
+                # Page was cleared - every non-zero old byte changed
+                xor_data = old_data
+            elif old_data == self.zero_page:
+                xor_data = new_data
+            else:
+                xor_data = bytearray(map(operator.xor, new_data, old_data))
+            runs.extend([(page, col_pos, new_data[col_pos:col_pos+count])
+                         for col_pos, count in find_diff_runs(xor_data)])
+            self.shadow[start:start+columns] = new_data
+        # Send the changes to the chip
+        last_page = last_col = None
+        for page, col_pos, data in runs:
+            if page != last_page:
+                # Set page and column position registers and send data
+                self.send_combined(self.position_cmds[page][col_pos], data)
+            elif col_pos != last_col:
+                # Same page - only the column position needs to be set
+                self.send_combined(self.column_cmds[col_pos], data)
+            else:
+                # Continues from the end of the previous run
+                self.send(data, is_data=True)
+            last_page = page
+            last_col = col_pos + len(data)
+    def _swizzle_blocks(self, data):
+        # Convert a sequence of 8x8 pixel blocks from "rows of pixels"
+        # format to "columns of pixels" (using the C helper code)
+        data = bytes(bytearray(data))
+        out = self.ffi_main.new('uint8_t[]', len(data))
+        self.ffi_lib.swizzle_blocks(out, data, len(data) // 8)
+        return self.ffi_main.buffer(out)[:]
     def _swizzle_bits(self, data):
-        # Convert from "rows of pixels" format to "columns of pixels"
-        top = bot = 0
-        for row in range(8):
-            spaced = (data[row] * 0x8040201008040201) & 0x8080808080808080
-            top |= spaced >> (7 - row)
-            spaced = (data[row + 8] * 0x8040201008040201) & 0x8080808080808080
-            bot |= spaced >> (7 - row)
-        bits_top = [(top >> s) & 0xff for s in range(0, 64, 8)]
-        bits_bot = [(bot >> s) & 0xff for s in range(0, 64, 8)]
-        return (bytearray(bits_top), bytearray(bits_bot))
+        bits = self._swizzle_blocks(data)
+        return (bits[:8], bits[8:])
     def set_glyphs(self, glyphs):
+        icon_names = []
+        icon_data = bytearray()
         for glyph_name, glyph_data in glyphs.items():
             icon = glyph_data.get('icon16x16')
             if icon is not None:
-                top1, bot1 = self._swizzle_bits(icon[0])
-                top2, bot2 = self._swizzle_bits(icon[1])
-                self.icons[glyph_name] = (top1 + top2, bot1 + bot2)
+                icon_names.append(glyph_name)
+                icon_data.extend(icon[0])
+                icon_data.extend(icon[1])
+        # Convert all the icons at once
+        icon_data = self._swizzle_blocks(icon_data)
+        for i, glyph_name in enumerate(icon_names):
+            top1, bot1, top2, bot2 = [icon_data[pos:pos+8]
+                                      for pos in range(i*32, i*32 + 32, 8)]
+            self.icons[glyph_name] = (top1 + top2, bot1 + bot2)
     def write_text(self, x, y, data):
+        if y >= 4:
+            return
         if x + len(data) > 16:
             data = data[:16 - min(x, 16)]
         pix_x = x * 8
         pix_x += self.x_offset
-        page_top = self.vram[y * 2]
-        page_bot = self.vram[y * 2 + 1]
-        for c in bytearray(data):
-            bits_top, bits_bot = self.font[c]
-            page_top[pix_x:pix_x+8] = bits_top
-            page_bot[pix_x:pix_x+8] = bits_bot
-            pix_x += 8
+        pos = y * 2 * self.columns + pix_x
+        bot_pos = pos + self.columns
+        self.dirty_pages |= 0x03 << (y * 2)
+        data = bytearray(data)
+        count = len(data) * 8
+        self.vram[pos:pos+count] = b''.join([self.font_top[c] for c in data])
+        self.vram[bot_pos:bot_pos+count] = b''.join(
+            [self.font_bot[c] for c in data])
+    def _write_char(self, x, y, c):
+        pos = y * 2 * self.columns + x * 8 + self.x_offset
+        bot_pos = pos + self.columns
+        self.vram[pos:pos+8] = self.font_top[c]
+        self.vram[bot_pos:bot_pos+8] = self.font_bot[c]
+        self.dirty_pages |= 0x03 << (y * 2)
     def write_graphics(self, x, y, data):
         if x >= 16 or y >= 4 or len(data) != 16:
             return
         bits_top, bits_bot = self._swizzle_bits(data)
         pix_x = x * 8
         pix_x += self.x_offset
-        page_top = self.vram[y * 2]
-        page_bot = self.vram[y * 2 + 1]
-        for i in range(8):
-            page_top[pix_x + i] ^= bits_top[i]
-            page_bot[pix_x + i] ^= bits_bot[i]
+        pos = y * 2 * self.columns + pix_x
+        self.dirty_pages |= 0x03 << (y * 2)
+        xor_block(self.vram, pos, bits_top)
+        xor_block(self.vram, pos + self.columns, bits_bot)
     def write_glyph(self, x, y, glyph_name):
+        if y >= 4:
+            return 0
         icon = self.icons.get(glyph_name)
         if icon is not None and x < 15:
             # Draw icon in graphics mode
             pix_x = x * 8
             pix_x += self.x_offset
-            page_idx = y * 2
-            self.vram[page_idx][pix_x:pix_x+16] = icon[0]
-            self.vram[page_idx + 1][pix_x:pix_x+16] = icon[1]
+            pos = y * 2 * self.columns + pix_x
+            bot_pos = pos + self.columns
+            self.vram[pos:pos+16] = icon[0]
+            self.vram[bot_pos:bot_pos+16] = icon[1]
+            self.dirty_pages |= 0x03 << (y * 2)
             return 2
         char = TextGlyphs.get(glyph_name)
         if char is not None:
             # Draw character
-            self.write_text(x, y, char)
+            if x < 16:
+                self._write_char(x, y, char)
             return 1
         return 0
     def clear(self):
-        zeros = bytearray(self.columns)
-        for page in self.vram:
-            page[:] = zeros
+        self.vram[:] = bytearray(len(self.vram))
+        self.dirty_pages = 0xff
     def get_dimensions(self):
         return (16, 4)
 
@@ -125,6 +196,9 @@ class SPI4wire:
         self.mcu_dc.update_digital_out(is_data,
                                        reqclock=BACKGROUND_PRIORITY_CLOCK)
         self.spi.spi_send(cmds, reqclock=BACKGROUND_PRIORITY_CLOCK)
+    def send_combined(self, cmds, data):
+        self.send(cmds)
+        self.send(data, is_data=True)
 
 # IO wrapper for i2c bus
 class I2C:
@@ -136,9 +210,20 @@ class I2C:
             hdr = 0x40
         else:
             hdr = 0x00
-        cmds = bytearray(cmds)
-        cmds.insert(0, hdr)
-        self.i2c.i2c_write(cmds, reqclock=BACKGROUND_PRIORITY_CLOCK)
+        msg = bytearray(len(cmds) + 1)
+        msg[0] = hdr
+        msg[1:] = cmds
+        self.i2c.i2c_write(msg, reqclock=BACKGROUND_PRIORITY_CLOCK)
+    def send_combined(self, cmds, data):
+        # Send commands and data in a single i2c transfer - each command
+        # byte is preceded by a control byte with the continuation bit set
+        msg = bytearray()
+        for cmd in bytearray(cmds):
+            msg.append(0x80)
+            msg.append(cmd)
+        msg.append(0x40)
+        msg.extend(data)
+        self.i2c.i2c_write(msg, reqclock=BACKGROUND_PRIORITY_CLOCK)
 
 # Helper code for toggling a reset pin on startup
 class ResetHelper:
@@ -188,10 +273,10 @@ class UC1701(DisplayBase):
                      0xAC, # Set static indicator off
                      0x00, # NOP
                      0xA6, # Disable Inverse
-                     0xAF] # Set display enable
+                     0xAF, # Set display enable
+                     0xA5, # display all
+                     0xA4] # normal display
         self.send(init_cmds)
-        self.send([0xA5]) # display all
-        self.send([0xA4]) # normal display
         self.flush()
 
 # The SSD1306 supports both i2c and "4-wire" spi
@@ -275,86 +360,80 @@ class SH1106(SSD1306):
 #define ST77XX_YELLOW 0xFFE0
 #define ST77XX_ORANGE 0xFC00
 
+ST7789_WIDTH = 320
+ST7789_HEIGHT = 240
+# Pixel data bytes per spi_send (keeps each command within the 64 byte
+# mcu message limit)
+ST7789_MAX_TRANSFER = 48
+
+# The ST7789 is a 320x240 color display - it is driven as a 128x64
+# monochrome display with the framebuffer scaled up and converted to
+# RGB565 on each flush (this requires numpy)
 class ST7789(DisplayBase): #for kobra 2 neo display
-    
-    def __init__(self, config, columns=128, x_offset=0): #display is 320x240, converting 1:2 to 3:4. might be stretched. Further looking into that can be done after this is tested
+    def __init__(self, config):
         io = SPI4wire(config, "dc_pin")
-        io_bus = io.spi
-        self.reset = ResetHelper(config.get("reset_pin", None), io_bus)
-        DisplayBase.__init__(self, io, columns, x_offset)
-        #self.contrast = config.getint('contrast', 239, minval=0, maxval=255)
-        #self.vcomh = config.getint('vcomh', 0, minval=0, maxval=63)
+        self.reset = ResetHelper(config.get("reset_pin", None), io.spi)
+        DisplayBase.__init__(self, io)
+        self.spi = io.spi
+        self.mcu_dc = io.mcu_dc
         self.invert = config.getboolean('invert', False)
-
-        self.NEW_WIDTH = 320
-        self.NEW_HEIGHT = 240
-        self.new_framebuffer = [[0] * self.NEW_WIDTH for _ in range(self.NEW_HEIGHT)]
-        self.old_framebuffer = [[0] * self.NEW_WIDTH for _ in range(self.NEW_HEIGHT)]
-        
+        try:
+            self.numpy = np = importlib.import_module('numpy')
+        except ImportError:
+            raise config.error(
+                "Failed to import `numpy` module, make sure it was "
+                "installed via `~/klippy-env/bin/pip install`")
+        # Map each display pixel to its framebuffer pixel
+        self.x_map = np.arange(ST7789_WIDTH) * self.columns // ST7789_WIDTH
+        self.y_map = np.arange(ST7789_HEIGHT) * 64 // ST7789_HEIGHT
+        # RGB565 contents of the chip (0x0001 is never sent, so the first
+        # flush updates every pixel)
+        self.pixels = np.full((ST7789_HEIGHT, ST7789_WIDTH), 0x0001,
+                              dtype='>u2')
     def set_address_window(self, x0, y0, x1, y1):
-            self.send([0x2A], is_data=False) #CASET column address set command
-            self.send([(x0 >> 8) & 0xFF, x0 & 0xFF, (x1 >> 8) & 0xFF, x1 & 0xFF], is_data=True)
-    
-            self.send([0x2B], is_data=False) #RASET row address set command
-            self.send([(y0 >> 8) & 0xFF, y0 & 0xFF, (y1 >> 8) & 0xFF, y1 & 0xFF], is_data=True)
-        self.send([0x2C], is_data=False) #write to ram
-        
-
-    def flush(self): #this is here to override the default inherited flush command and replace it with a version that converts the framebuffer of binary pixels to properly spaced RGB values for the ST7789   
-            
-        for new_data, old_data in self.all_framebuffers:
-            
-            def scale_framebuffer(new_data):
-                for y in range(self.NEW_HEIGHT):
-                    for x in range(self.NEW_WIDTH):
-                        # Calculate corresponding coordinates in the old framebuffer
-                        old_x = x * 128 // self.NEW_WIDTH  # Map x coordinate
-                        old_y = y * 64 //  self.NEW_HEIGHT  # Map y coordinate
-                        
-                        # Convert black-and-white to 16-bit RGB
-                        pixel_value = new_data[old_y][old_x]
-                        if pixel_value:  # Assuming non-zero means white
-                            self.new_framebuffer[y][x] = 0xFFFF  # White in 16-bit RGB
-                        else:
-                            self.new_framebuffer[y][x] = 0x0000  # Black in 16-bit RGB
-    
-              # Convert old_data to the new framebuffer resolution
-            scale_framebuffer(new_data)
-        
-                    # Find all differences in the framebuffers and send them to the chip 
-                if self.new_framebuffer == self.old_framebuffer:
-                    continue
-        
-                # Identify changed bytes
-                diffs = [[i, 1] for i, (n, o) in enumerate(zip(self.new_framebuffer, self.old_framebuffer)) if n != o]
-            
-                # Batch nearby changes
-                for i in range(len(diffs)-2, -1, -1):
-                    pos, count = diffs[i]
-                    nextpos, nextcount = diffs[i+1]
-                    if pos + 5 >= nextpos and nextcount < 16:
-                        diffs[i][1] = nextcount + (nextpos - pos)
-                        del diffs[i+1]
-                # Transmit changes
-                for col_pos, count in diffs:
-
-                    #set address window
-                    x_start = col_pos
-                    x_end = col_pos + count - 1
-                    y_start = 0
-                    y_end = 240
-                  
-                    set_address_window(x_start, y_start, x_end, y_end)
-                    self.send(new_data[col_pos:col_pos+count], is_data=True)
-        
-            old_data[:] = new_data  # Update old_data for the next loop
-            old_framebuffer[:] = new_framebuffer #update scaled framebuffer
-
-            
-      def init(self):
+        self.send([0x2A]) # CASET column address set
+        self.send(struct.pack('>HH', x0, x1), is_data=True)
+        self.send([0x2B]) # RASET row address set
+        self.send(struct.pack('>HH', y0, y1), is_data=True)
+        self.send([0x2C]) # RAMWR write to ram
+    def flush(self):
+        if not self.dirty_pages:
+            return
+        self.dirty_pages = 0
+        np = self.numpy
+        # Unpack the framebuffer pages (8 rows per byte, lsb on top) into
+        # a 64 row bit-plane, scale it, and convert it to RGB565
+        pages = np.frombuffer(self.vram, dtype=np.uint8).reshape(
+            8, self.columns, 1)
+        # (unpackbits is msb first - flip so bit 0 is the top row)
+        plane = np.unpackbits(pages, axis=2)[:, :, ::-1]
+        plane = plane.transpose(0, 2, 1).reshape(64, self.columns)
+        scaled = plane[self.y_map[:, None], self.x_map[None, :]]
+        pixels = np.where(scaled, 0xFFFF, 0x0000).astype('>u2')
+        # Find the rows that changed and send them in contiguous blocks
+        diffs = pixels != self.pixels
+        rows = np.flatnonzero(diffs.any(axis=1))
+        if not len(rows):
+            return
+        breaks = np.flatnonzero(np.diff(rows) > 1) + 1
+        for block in np.split(rows, breaks):
+            y0, y1 = int(block[0]), int(block[-1])
+            cols = np.flatnonzero(diffs[y0:y1+1].any(axis=0))
+            x0, x1 = int(cols[0]), int(cols[-1])
+            self.set_address_window(x0, y0, x1, y1)
+            # Stream the pixel data with the data/command pin held high
+            self.mcu_dc.update_digital_out(1,
+                                           reqclock=BACKGROUND_PRIORITY_CLOCK)
+            data = memoryview(pixels[y0:y1+1, x0:x1+1].tobytes())
+            for pos in range(0, len(data), ST7789_MAX_TRANSFER):
+                self.spi.spi_send(data[pos:pos+ST7789_MAX_TRANSFER],
+                                  reqclock=BACKGROUND_PRIORITY_CLOCK)
+        self.pixels = pixels
+    def init(self):
         self.reset.init()
         init_sequence = [
             (0x3A, [0x55]), # color mode 16bit
+            (0x36, [0x60]), # memory access control (landscape)
             (0xB2, [0x0C, 0x0C, 0x00, 0x33, 0x33]), # porch control
             (0xB7, [0x35]), # gate control
             (0xBB, [0x19]), # VCOM setting
@@ -364,16 +443,22 @@ class ST7789(DisplayBase): #for kobra 2 neo display
             (0xC4, [0x20]), # VDV set
             (0xC6, [0x0F]), # frame rate
             (0xD0, [0xA4, 0xA1]), # power control
-            (0xE0, [0xD0, 0x04, 0x0D, 0x11, 0x13, 0x2B, 0x3F, 0x54, 0x4C, 0x18, 0x0D, 0x0B, 0x1F, 0x23]), # positive gamma
-            (0xE1, [0xD0, 0x04, 0x0C, 0x11, 0x13, 0x2C, 0x3F, 0x44, 0x51, 0x2F, 0x1F, 0x1F, 0x20, 0x23]), # negative gamma
+            (0xE0, [0xD0, 0x04, 0x0D, 0x11, 0x13, 0x2B, 0x3F, 0x54, 0x4C,
+                    0x18, 0x0D, 0x0B, 0x1F, 0x23]), # positive gamma
+            (0xE1, [0xD0, 0x04, 0x0C, 0x11, 0x13, 0x2C, 0x3F, 0x44, 0x51,
+                    0x2F, 0x1F, 0x1F, 0x20, 0x23]), # negative gamma
             ((0x21 if self.invert else 0x20), []), # set invert
             (0x11, []), # out of sleep
             (0x13, []), # normal display
             (0x29, []), # display on
         ]
-    
+        # Send consecutive commands without parameters in one transfer
+        cmds = []
         for cmd, data in init_sequence:
-            self.send([cmd], is_data=False)  # Send the command first
+            cmds.append(cmd)
             if data:
-                self.send(data, is_data=True)  # Then send the data
-
+                self.send_combined(cmds, data)
+                cmds = []
+        if cmds:
+            self.send(cmds)
+        self.flush()